@@ -1,16 +1,40 @@
 import os
-import json
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
 from typing import Dict, Any
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import jsonpickle
+import aiofiles
+import orjson
+import pebble
 
-from models import Workspace, ExecutionRequest, ExecutionResult
+from models import Workspace, ExecutionRequest
 from code_executor import CodeExecutor
 
+# Queue of pending (request, future) pairs; a background consumer batches
+# them so a burst of /execute calls loads the workspace once, not N times
+_execute_queue: asyncio.Queue = asyncio.Queue()
+BATCH_WINDOW_SECONDS = 0.005
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the execute-batching consumer for the lifetime of the app
+    worker = asyncio.create_task(_execute_worker())
+    yield
+    worker.cancel()
+    # Flush any pending debounced save: the update was already acknowledged
+    # with a success response, so it must not die with the process
+    if _save_task is not None and not _save_task.done():
+        _save_task.cancel()
+    if _workspace_dirty and _workspace_cache is not None:
+        await save_workspace_to_file(_workspace_cache)
+
 # Initialize FastAPI app
-app = FastAPI(title="2D Canvas Jupyter")
+app = FastAPI(title="2D Canvas Jupyter", default_response_class=ORJSONResponse,
+              lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -24,6 +48,87 @@ app.add_middleware(
 # Initialize code executor
 executor = CodeExecutor()
 
+# Process pool for user code: exec() is CPU-bound and would otherwise run on
+# the event loop thread, freezing every other request for its duration.
+# pebble's pool terminates (and replaces) a worker whose task exceeds its
+# timeout, so runaway user code can't permanently occupy a worker.
+pool = pebble.ProcessPool(max_workers=os.cpu_count())
+
+# Cap on how long a single box execution may run
+EXECUTE_TIMEOUT_SECONDS = 30.0
+
+def run_box(box_id: str, code: str, workspace: Dict[str, Any]) -> Dict[str, Any]:
+    """Entry point for worker processes: execute a box against the workspace.
+
+    Uses the module-level CodeExecutor so each worker keeps its own
+    execution cache across requests."""
+    try:
+        return executor.execute_with_dependencies(
+            box_id,
+            code,
+            workspace["boxes"],
+            workspace["arrows"]
+        )
+    except BaseException as e:
+        # User code can raise SystemExit (exit()) or KeyboardInterrupt, which
+        # the executor's Exception handlers don't catch; turn them into a
+        # normal error result instead of letting them escape the worker
+        return {"output": f"{type(e).__name__}: {e}", "error": True}
+
+async def _dispatch_execution(request: "ExecutionRequest", future: asyncio.Future,
+                              workspace: Dict[str, Any]) -> None:
+    """Run one queued execution on the process pool and resolve its future."""
+    try:
+        # The pool enforces the timeout itself: on expiry it kills the worker
+        # process running the task, so the runaway code actually stops
+        task = pool.schedule(run_box, args=(request.boxId, request.code, workspace),
+                             timeout=EXECUTE_TIMEOUT_SECONDS)
+        result = await asyncio.wrap_future(task)
+        # The endpoint's backstop timeout may have cancelled the future
+        # while the task was still queued; resolving it again would raise
+        # InvalidStateError
+        if not future.done():
+            future.set_result(result)
+    except asyncio.CancelledError:
+        raise
+    except BaseException as e:
+        # Resolve the future no matter what surfaced from the pool —
+        # an unresolved future would hang its /execute request forever
+        if not future.done():
+            future.set_exception(e)
+
+async def _execute_worker() -> None:
+    """Consume the execute queue, coalescing requests that arrive within the
+    batching window so the workspace is loaded once per burst."""
+    while True:
+        batch = [await _execute_queue.get()]
+        # One bounded wait for stragglers, then a non-blocking drain; waiting
+        # per item would let a sustained stream extend the window forever
+        try:
+            batch.append(await asyncio.wait_for(
+                _execute_queue.get(), timeout=BATCH_WINDOW_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+        while True:
+            try:
+                batch.append(_execute_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        # One workspace load for the whole batch; executions run concurrently.
+        # Any failure here fails this batch's futures but must never kill the
+        # consumer — with it dead, every later /execute would hang.
+        try:
+            workspace = await load_workspace_from_file()
+            for request, future in batch:
+                asyncio.create_task(_dispatch_execution(request, future, workspace))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
 # Define storage path
 STORAGE_DIR = "storage"
 WORKSPACE_FILE = os.path.join(STORAGE_DIR, "workspace.json")
@@ -31,56 +136,125 @@ WORKSPACE_FILE = os.path.join(STORAGE_DIR, "workspace.json")
 # Ensure storage directory exists
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
+# In-memory workspace cache so /execute doesn't reparse the file each call.
+# While dirty, the cache is newer than the file and must not be reloaded.
+_workspace_cache: Dict[str, Any] | None = None
+_workspace_mtime: float | None = None
+_workspace_dirty: bool = False
+
+# Pending debounced write-back task (coalesces rapid /workspace updates)
+_save_task: asyncio.Task | None = None
+SAVE_DEBOUNCE_SECONDS = 0.05
+
 # Helper functions
-def save_workspace_to_file(workspace: Dict[str, Any]) -> None:
-    """Save workspace data to file"""
-    with open(WORKSPACE_FILE, "w") as f:
-        # Use jsonpickle to handle complex objects
-        json.dump(workspace, f, indent=2)
-
-def load_workspace_from_file() -> Dict[str, Any]:
-    """Load workspace data from file"""
+def _write_workspace_atomic(data: bytes) -> None:
+    """Write serialized workspace bytes to a tempfile in one syscall, then
+    atomically replace the real file so a crash never leaves half-written JSON.
+
+    The tempfile name is unique per save: a cancelled debounced save may
+    still be writing on its thread when the next save starts, and sharing a
+    fixed tmp path would let the two writes interleave."""
+    fd, tmp = tempfile.mkstemp(dir=STORAGE_DIR, suffix=".tmp")
+    try:
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, WORKSPACE_FILE)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+async def save_workspace_to_file(workspace: Dict[str, Any]) -> None:
+    """Save workspace data to file without blocking the event loop"""
+    global _workspace_mtime, _workspace_dirty
+    # Serialize once into a buffer; orjson emits compact bytes directly
+    data = await asyncio.to_thread(orjson.dumps, workspace)
+    await asyncio.to_thread(_write_workspace_atomic, data)
+    _workspace_mtime = os.stat(WORKSPACE_FILE).st_mtime
+    _workspace_dirty = False
+
+async def _debounced_save(workspace: Dict[str, Any]) -> None:
+    """Wait out the debounce window, then persist the workspace"""
+    await asyncio.sleep(SAVE_DEBOUNCE_SECONDS)
+    await save_workspace_to_file(workspace)
+
+def schedule_workspace_save(workspace: Dict[str, Any]) -> None:
+    """Schedule an async write-back, dropping any pending one so rapid
+    updates coalesce into a single disk write"""
+    global _save_task
+    if _save_task is not None and not _save_task.done():
+        _save_task.cancel()
+    _save_task = asyncio.create_task(_debounced_save(workspace))
+
+async def load_workspace_from_file() -> Dict[str, Any]:
+    """Load workspace data, serving from the in-memory cache when the
+    file on disk hasn't changed"""
+    global _workspace_cache, _workspace_mtime
     try:
-        with open(WORKSPACE_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # Return empty workspace if file doesn't exist or is invalid
-        return {"boxes": [], "arrows": []}
+        mtime = os.stat(WORKSPACE_FILE).st_mtime
+    except FileNotFoundError:
+        mtime = None
+
+    if _workspace_cache is not None and (_workspace_dirty or mtime == _workspace_mtime):
+        return _workspace_cache
+
+    try:
+        async with aiofiles.open(WORKSPACE_FILE, "rb") as f:
+            data = await f.read()
+        _workspace_cache = await asyncio.to_thread(orjson.loads, data)
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        # Fall back to an empty workspace if the file is missing or invalid
+        _workspace_cache = {"boxes": [], "arrows": []}
+    _workspace_mtime = mtime
+    return _workspace_cache
 
 # API Endpoints
 @app.get("/")
 async def read_root():
     return {"message": "2D Canvas Jupyter API"}
 
-@app.get("/workspace", response_model=Workspace)
+@app.get("/workspace", response_model=None)
 async def get_workspace():
     """Get the current workspace"""
-    return load_workspace_from_file()
+    # The cached dict is already response-shaped; skip pydantic's response
+    # validation pass and serialize it directly
+    return ORJSONResponse(await load_workspace_from_file())
 
 @app.post("/workspace", response_model=Dict[str, str])
 async def update_workspace(workspace: Workspace):
     """Update the workspace"""
-    save_workspace_to_file(workspace.dict())
+    global _workspace_cache, _workspace_dirty
+    # Update the cache immediately; disk write happens in the background
+    _workspace_cache = workspace.model_dump()
+    _workspace_dirty = True
+    schedule_workspace_save(_workspace_cache)
     return {"status": "success"}
 
-@app.post("/execute", response_model=ExecutionResult)
+@app.post("/execute", response_model=None)
 async def execute_code(request: ExecutionRequest):
     """Execute Python code"""
     try:
-        # Load current workspace
-        workspace = load_workspace_from_file()
-
-        # Execute the code
-        result = executor.execute_with_dependencies(
-            request.boxId,
-            request.code,
-            workspace["boxes"],
-            workspace["arrows"]
-        )
-        return result
+        # Hand off to the batching consumer and wait for our result; the
+        # outer timeout is a backstop in case the future is never resolved
+        future = asyncio.get_running_loop().create_future()
+        await _execute_queue.put((request, future))
+        result = await asyncio.wait_for(future, timeout=EXECUTE_TIMEOUT_SECONDS + 5.0)
+    except asyncio.TimeoutError:
+        result = {
+            "output": f"Execution timed out after {EXECUTE_TIMEOUT_SECONDS:.0f} seconds",
+            "error": True
+        }
     except Exception as e:
         # Return error information
-        return ExecutionResult(output=str(e), error=True)
+        result = {"output": str(e), "error": True}
+    # Executor results are plain dicts (potentially PNG-bearing); serialize
+    # them directly instead of round-tripping through pydantic validation
+    return ORJSONResponse(result)
 
 # Start the server if running as a script
 if __name__ == "__main__":
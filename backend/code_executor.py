@@ -2,128 +2,308 @@ import sys
 import io
 import traceback
 import json
-import base64
 import ast
-from typing import Dict, Any, List, Tuple, Set
+import copy
+import functools
+import hashlib
+import threading
+import types
+from collections import defaultdict, deque
+from types import CodeType
+from typing import Dict, Any, List, Tuple
 from contextlib import redirect_stdout, redirect_stderr
 
+import pybase64
+from cachetools import LRUCache
+
 from models import Ancestor
 
+# Bound on the executor-level caches; keeps memory flat across long editing
+# sessions while preserving the hit rate for the active part of a workspace
+CACHE_MAX_ENTRIES = 256
+
+# How many stack frames to include when formatting an execution error; keeps
+# the error path O(1) even for deep recursion in user code
+TRACEBACK_FRAME_LIMIT = 20
+
+def _format_error(e: BaseException) -> str:
+    """Format an exception with a bounded traceback."""
+    error_msg = f"{type(e).__name__}: {str(e)}\n"
+    error_msg += ''.join(traceback.format_exception(
+        type(e), e, e.__traceback__, limit=TRACEBACK_FRAME_LIMIT))
+    return error_msg
+
 # Import and configure matplotlib at module level
 import matplotlib
 matplotlib.use('Agg')  # Non-interactive backend
 import matplotlib.pyplot as plt
 
+import math
+import numpy
+
+# Baseline bindings shared by every fresh execution environment. Importing
+# these once at server start means user boxes doing the usual
+# "import numpy as np" boilerplate hit sys.modules instead of paying the
+# full import cost, and the common aliases are available immediately.
+_BASE_ENV = {
+    'math': math,
+    'np': numpy,
+    'plt': plt,
+}
+
+# Reusable stdout/stderr capture buffers, one pair per thread, so every
+# execution doesn't allocate two fresh StringIOs
+_capture_bufs = threading.local()
+
+def _get_capture_bufs() -> Tuple[io.StringIO, io.StringIO]:
+    """Return this thread's (stdout, stderr) capture buffers, reset to empty."""
+    bufs = getattr(_capture_bufs, 'bufs', None)
+    if bufs is None:
+        bufs = (io.StringIO(), io.StringIO())
+        _capture_bufs.bufs = bufs
+    for buf in bufs:
+        buf.seek(0)
+        buf.truncate()
+    return bufs
+
+def _snapshot_env(env: Dict[str, Any]) -> Dict[str, Any] | None:
+    """Deep-copy an environment for caching, or return None if it can't be
+    copied safely.
+
+    Cached snapshots must not share mutable objects with running code:
+    a later box doing e.g. acc.append(...) would otherwise silently corrupt
+    every earlier prefix snapshot. Modules (and __builtins__) are kept by
+    reference since they're process-global singletons anyway; anything that
+    refuses to deep-copy makes the environment uncacheable."""
+    snapshot = {}
+    for name, value in env.items():
+        if name == '__builtins__' or isinstance(value, types.ModuleType):
+            snapshot[name] = value
+        else:
+            try:
+                snapshot[name] = copy.deepcopy(value)
+            except Exception:
+                return None
+    return snapshot
+
+# Names and modules that make a box's result non-deterministic or dependent
+# on the outside world; such boxes are never served from the result cache
+_IMPURE_NAMES = {'open', 'input'}
+_IMPURE_MODULES = {'socket', 'http', 'urllib', 'requests', 'random', 'time',
+                   'datetime', 'numpy.random'}
+
+def _is_impure_module(name: str) -> bool:
+    """Check a dotted module path against the block list, including prefixes
+    (so 'numpy.random.mtrand' matches 'numpy.random')."""
+    parts = name.split('.')
+    return any('.'.join(parts[:i]) in _IMPURE_MODULES
+               for i in range(1, len(parts) + 1))
+
+@functools.lru_cache(maxsize=512)
+def _is_result_cacheable(code: str) -> bool:
+    """Statically check whether a box looks pure enough that its formatted
+    result can be reused for identical (content, ancestor chain) pairs."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in _IMPURE_NAMES:
+            return False
+        # The preloaded np alias needs no import statement, so catch
+        # np.random / numpy.random used directly as an attribute
+        if isinstance(node, ast.Attribute):
+            if (node.attr == 'random' and isinstance(node.value, ast.Name)
+                    and node.value.id in ('np', 'numpy')):
+                return False
+        if isinstance(node, ast.Import):
+            if any(_is_impure_module(alias.name) for alias in node.names):
+                return False
+        if isinstance(node, ast.ImportFrom):
+            if node.module and (_is_impure_module(node.module) or any(
+                    _is_impure_module(f"{node.module}.{alias.name}")
+                    for alias in node.names)):
+                return False
+    return True
+
+@functools.lru_cache(maxsize=512)
+def _compile(code: str) -> Tuple[CodeType, bool]:
+    """Compile box code, capturing the value of a trailing expression into
+    `_last_expr_result`. Memoized so re-executing the same box content (e.g.
+    as an ancestor of several boxes) skips parsing and compilation entirely.
+
+    Returns (code_object, had_trailing_expression)."""
+    parsed = ast.parse(code)
+    last_node = parsed.body[-1] if parsed.body else None
+
+    if isinstance(last_node, ast.Expr):
+        # Rewrite the last expression node as an assignment to our special
+        # variable. Transforming the AST directly handles multiline
+        # expressions and indentation that line-based splicing would break.
+        assign = ast.Assign(
+            targets=[ast.Name(id='_last_expr_result', ctx=ast.Store())],
+            value=last_node.value,
+        )
+        parsed.body[-1] = ast.copy_location(assign, last_node)
+        ast.fix_missing_locations(parsed)
+        return compile(parsed, '<box>', 'exec'), True
+
+    return compile(parsed, '<box>', 'exec'), False
+
 class CodeExecutor:
     def __init__(self):
-        # Cache of execution results to avoid redundant computation
-        self.execution_cache = {}
+        # Process-lifetime cache of ancestor environments, keyed by the
+        # cumulative content hash of the executed ancestor chain. Survives
+        # across requests so iterating on a leaf box skips its ancestors.
+        self.execution_cache = LRUCache(maxsize=CACHE_MAX_ENTRIES)
+        # Formatted responses (PNG base64 included) for pure boxes, keyed by
+        # content + ancestor-chain hash; skips rasterization on re-execution
+        self.result_cache = LRUCache(maxsize=CACHE_MAX_ENTRIES)
 
     def reset_cache(self):
-        """Reset the execution cache."""
-        self.execution_cache = {}
+        """Reset the execution and result caches."""
+        self.execution_cache = LRUCache(maxsize=CACHE_MAX_ENTRIES)
+        self.result_cache = LRUCache(maxsize=CACHE_MAX_ENTRIES)
 
     def execute_with_dependencies(self, box_id: str, code: str, boxes: List[Dict], arrows: List[Dict]) -> Dict[str, Any]:
         """Execute code with dependencies determined from the DAG structure"""
-        # Reset cache for new execution
-        self.reset_cache()
+        # Box lookup table for faster access
+        box_lookup = {box['id']: box for box in boxes}
 
         # Build the adjacency list (node -> its parents)
-        graph = {}
-        for box in boxes:
-            graph[box['id']] = []
-
+        graph = defaultdict(list)
         for arrow in arrows:
-            if arrow['target'] in graph:
+            if arrow['target'] in box_lookup:
                 graph[arrow['target']].append(arrow['source'])
 
         # Find the box we're executing
-        target_box = next((box for box in boxes if box['id'] == box_id), None)
+        target_box = box_lookup.get(box_id)
         if not target_box:
             return {"output": f"Box with ID {box_id} not found", "error": True}
 
-        # Box lookup table for faster access
-        box_lookup = {box['id']: box for box in boxes}
-
         # Execute the box with its full dependency graph
         try:
-            # Create execution environment by traversing the DAG
-            env = self._execute_dag_node(box_id, graph, box_lookup, set())
+            # Execute the ancestors in topological order to build the environment
+            env, ancestors_key = self._execute_ancestors(box_id, graph, box_lookup)
+
+            # For pure boxes, reuse the formatted result (including any
+            # rendered PNG) when neither the box nor its ancestors changed
+            content = target_box['content']
+            cacheable = _is_result_cacheable(content)
+            if cacheable:
+                result_key = hashlib.blake2b(
+                    (content + '|' + ancestors_key).encode(),
+                    digest_size=16).hexdigest()
+                cached = self.result_cache.get(result_key)
+                if cached is not None:
+                    return cached
 
             # Execute the target box with the prepared environment
-            return self._execute_box_code(target_box['content'], env)
-        except Exception as e:
-            error_msg = f"{type(e).__name__}: {str(e)}\n"
-            error_msg += traceback.format_exc()
-            return {"output": error_msg, "error": True}
-
-    def _execute_dag_node(self, node_id: str, graph: Dict[str, List[str]],
-                          box_lookup: Dict[str, Dict], visited: Set[str]) -> Dict[str, Any]:
-        """Recursively execute a node in the DAG and return its environment."""
-        # Check if we've already executed this node
-        if node_id in self.execution_cache:
-            return self.execution_cache[node_id]
-
-        # Detect cycles
-        if node_id in visited:
-            raise ValueError(f"Cycle detected in dependency graph at node {node_id}")
-
-        visited.add(node_id)
-
-        # Get box content
-        if node_id not in box_lookup:
-            raise ValueError(f"Box with ID {node_id} not found in graph")
-
-        box = box_lookup[node_id]
-
-        # Get parents of this node
-        parents = graph.get(node_id, [])
-
-        # Base case: no parents, start with fresh environment
-        if not parents:
-            env = {}
-            result = self._execute_single_box(box['content'], env)
-            self.execution_cache[node_id] = result
-            visited.remove(node_id)
+            result = self._execute_box_code(content, env)
+            if cacheable and not result.get('error'):
+                self.result_cache[result_key] = result
             return result
-
-        # Recursive case: merge environments from all parents
-        merged_env = {}
-
-        # Execute all parents and merge their environments
-        for parent_id in parents:
-            parent_env = self._execute_dag_node(parent_id, graph, box_lookup, visited.copy())
-            # Update the merged environment with the parent's environment
-            # Later parents can override earlier ones if there are conflicts
-            merged_env.update(parent_env)
-
-        # Execute this node with the merged environment
-        result = self._execute_single_box(box['content'], merged_env)
-
-        # Cache the result
-        self.execution_cache[node_id] = result
-
-        # Remove from visited set
-        visited.remove(node_id)
-
-        return result
-
-    def _execute_single_box(self, code: str, env: Dict[str, Any]) -> Dict[str, Any]:
-        """Execute code in a box with the given environment and return the updated environment."""
+        except Exception as e:
+            return {"output": _format_error(e), "error": True}
+
+    def _execute_ancestors(self, box_id: str, graph: Dict[str, List[str]],
+                           box_lookup: Dict[str, Dict]) -> Tuple[Dict[str, Any], str]:
+        """Execute all ancestors of a box in topological order.
+
+        Returns the resulting environment and the cumulative hash of the
+        whole ancestor chain ('' when the box has no ancestors)."""
+        # Walk backward from the target to collect the ancestor sub-DAG,
+        # keeping BFS discovery order: iterating a set of ids would make
+        # tie-breaks among independent ancestors depend on hash randomization
+        subgraph = [box_id]
+        seen = {box_id}
+        queue = deque([box_id])
+        while queue:
+            node_id = queue.popleft()
+            for parent_id in graph.get(node_id, []):
+                if parent_id not in box_lookup:
+                    raise ValueError(f"Box with ID {parent_id} not found in graph")
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    subgraph.append(parent_id)
+                    queue.append(parent_id)
+
+        # Kahn's algorithm: in-degree of a node is its number of parents
+        # within the sub-DAG
+        in_degree = {node_id: len(graph.get(node_id, [])) for node_id in subgraph}
+        children = {node_id: [] for node_id in subgraph}
+        for node_id in subgraph:
+            for parent_id in graph.get(node_id, []):
+                children[parent_id].append(node_id)
+
+        ready = deque(node_id for node_id in subgraph if in_degree[node_id] == 0)
+        order = []
+        processed = 0
+        while ready:
+            node_id = ready.popleft()
+            processed += 1
+            # The target box itself is executed separately by the caller
+            if node_id != box_id:
+                order.append(node_id)
+            for child_id in children[node_id]:
+                in_degree[child_id] -= 1
+                if in_degree[child_id] == 0:
+                    ready.append(child_id)
+
+        # If the topological order didn't cover the sub-DAG, there's a cycle
+        if processed != len(subgraph):
+            raise ValueError("Cycle detected in dependency graph")
+
+        # Hash the cumulative content of each topo prefix so an unchanged
+        # ancestor chain can be resumed from its cached environment
+        hasher = hashlib.blake2b(digest_size=16)
+        keys = []
+        for node_id in order:
+            hasher.update(box_lookup[node_id]['content'].encode())
+            hasher.update(b'\x00')
+            keys.append(hasher.hexdigest())
+
+        # Resume from the longest prefix already in the cache. The cached
+        # snapshot is deep-copied again on the way out so the code we're
+        # about to run can't mutate it in place.
+        env = dict(_BASE_ENV)
+        start = 0
+        for i in range(len(order) - 1, -1, -1):
+            cached = self.execution_cache.get(keys[i])
+            if cached is not None:
+                restored = _snapshot_env(cached)
+                if restored is not None:
+                    env = restored
+                    start = i + 1
+                    break
+
+        # Execute the remaining ancestors, snapshotting after each one;
+        # environments holding uncopyable objects simply aren't cached
+        for i in range(start, len(order)):
+            self._execute_single_box(box_lookup[order[i]]['content'], env)
+            snapshot = _snapshot_env(env)
+            if snapshot is not None:
+                self.execution_cache[keys[i]] = snapshot
+
+        return env, keys[-1] if keys else ''
+
+    def _execute_single_box(self, code: str, env: Dict[str, Any]) -> None:
+        """Execute code in a box, mutating the shared environment in place.
+
+        All nodes run in topological order against one environment, so later
+        boxes naturally see (and may override) earlier bindings without any
+        per-node dict copies."""
         try:
             # Execute the code in the environment
             self._execute_code(code, env)
-            return env.copy()  # Return a copy to avoid unintended mutations
         except Exception as e:
             # Log the error but continue execution
             print(f"Warning: Box execution failed: {str(e)}")
-            return env.copy()  # Return the unmodified environment
 
     def _execute_box_code(self, code: str, env: Dict[str, Any]) -> Dict[str, Any]:
         """Execute the box code and return formatted results for the frontend."""
         try:
-            stdout = io.StringIO()
-            stderr = io.StringIO()
+            stdout, stderr = _get_capture_bufs()
 
             with redirect_stdout(stdout), redirect_stderr(stderr):
                 last_expr = self._execute_code(code, env)
@@ -141,12 +321,14 @@ class CodeExecutor:
 
             # Check if the last expression is a matplotlib figure
             if isinstance(last_expr, matplotlib.figure.Figure):
-                # Convert figure to PNG
+                # Convert figure to PNG. Skip bbox_inches='tight' (it forces
+                # an extra render pass) and trade PNG size for encode speed;
+                # pybase64 gives a SIMD-accelerated base64 encode.
                 buf = io.BytesIO()
-                last_expr.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-                buf.seek(0)
+                last_expr.savefig(buf, format='png', dpi=80,
+                                  pil_kwargs={'compress_level': 1})
                 png_data = buf.getvalue()
-                png_base64 = base64.b64encode(png_data).decode('utf-8')
+                png_base64 = pybase64.b64encode(png_data).decode('ascii')
 
                 return {
                     "output": {
@@ -187,38 +369,20 @@ class CodeExecutor:
 
         except Exception as e:
             # Handle execution errors
-            error_msg = f"{type(e).__name__}: {str(e)}\n"
-            error_msg += traceback.format_exc()
-            return {"output": error_msg, "error": True}
+            return {"output": _format_error(e), "error": True}
 
     def _execute_code(self, code: str, env: Dict[str, Any]) -> Any:
         """Execute the code and return the result of the last expression if any."""
         # Create a variable to store the last expression result
         env['_last_expr_result'] = None
 
-        # Check if the last statement is an expression
         try:
-            parsed = ast.parse(code)
-            last_node = parsed.body[-1] if parsed.body else None
-
-            if isinstance(last_node, ast.Expr):
-                # Modify the code to capture the last expression result
-                last_line_no = last_node.lineno
-                lines = code.splitlines()
-
-                # Replace the last expression with an assignment to our special variable
-                if last_line_no <= len(lines):
-                    last_line = lines[last_line_no - 1]
-                    lines[last_line_no - 1] = f"_last_expr_result = {last_line}"
-                    modified_code = "\n".join(lines)
-
-                    # Execute the modified code
-                    exec(modified_code, env)
-                    return env.get('_last_expr_result')
-        except:
-            # If there's any issue with AST parsing, fall back to normal execution
-            pass
-
-        # If we couldn't modify the code or it wasn't an expression, execute normally
-        exec(code, env)
-        return None
+            code_obj, had_expr = _compile(code)
+        except SyntaxError:
+            # If the transformed source doesn't compile, fall back to normal
+            # execution so the user sees the original error
+            exec(code, env)
+            return None
+
+        exec(code_obj, env)
+        return env.get('_last_expr_result') if had_expr else None